@@ -1,30 +1,230 @@
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 import streamlit as st
 import requests
-import folium
+import hashlib
+import io
 import os
+import re
+import threading
+import time
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+import diskcache
 from opencage.geocoder import OpenCageGeocode
+from ratelimit import limits, sleep_and_retry
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 st.set_page_config(layout="wide")
 
 # If there is a problem with the current API
 OPEN_CAGE_API_KEY = st.secrets["API_KEY"]
 
+# Persistent geocode cache, survives server restarts (entries expire after 30 days)
+GEOCODE_CACHE_DIR = ".geocache"
+GEOCODE_CACHE_EXPIRE = 30 * 86400
+
+# Addresses geocoded offline by scripts/refresh_geocodes.py
+GEOCODED_CLIENTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "clients_geocoded.parquet")
+
+# Geocoded client subsets, stored as Parquet files named after a hash of the
+# source rows so they are only geocoded again when the upstream data changes
+# (files expire like the geocode cache entries)
+GEOCODED_DATA_DIR = ".geocoded"
+
+# Parallel geocoding: number of worker threads, and OpenCage quota shared by
+# all of them (free tier allows 1 request per second)
+GEOCODE_WORKERS = 8
+GEOCODE_RATE_CALLS = 1
+GEOCODE_RATE_PERIOD = 1.0
+
+# Only the best match is used: skip extra candidates and annotations to keep
+# OpenCage responses small
+GEOCODE_PARAMS = {"limit": 1, "no_annotations": 1}
+
+# Optional Mapbox batch geocoding, used first when a token is configured;
+# OpenCage remains the fallback for addresses Mapbox does not match. Results
+# are requested as "permanent" since Mapbox only allows storing those.
+MAPBOX_ACCESS_TOKEN = st.secrets.get("MAPBOX_ACCESS_TOKEN")
+MAPBOX_BATCH_URL = "https://api.mapbox.com/search/geocode/v6/batch"
+MAPBOX_BATCH_SIZE = 1000
+# Mapbox fuzzy-matches instead of returning nothing: only precise matches in
+# France are kept, anything else goes to OpenCage
+MAPBOX_QUERY_OPTIONS = {"country": "fr", "autocomplete": False, "limit": 1}
+MAPBOX_FEATURE_TYPES = ("address", "street")
+
+# Javascript building each client marker in the browser, from a row
+# [lat, lng, popup]
+MARKER_CALLBACK = """
+function (row) {
+    var icon = L.AwesomeMarkers.icon({icon: 'info-sign', prefix: 'glyphicon', markerColor: 'darkgreen'});
+    var marker = L.marker(new L.LatLng(row[0], row[1]), {icon: icon});
+    marker.bindPopup(row[2]);
+    return marker;
+}
+"""
+
 # =============================================================================
 # Caching functions to speed up repeated runs
 # =============================================================================
 
-@st.cache_data(show_spinner=False)
+@st.cache_resource(show_spinner=False)
+def get_http_session():
+    """Single HTTP session shared by every download, keeping connections alive."""
+    return requests.Session()
+
+@st.cache_resource(show_spinner=False)
 def load_data():
-    """Load client data from CSV."""
+    """
+    Load client data from CSV.
+    
+    Returns:
+        pyarrow.Table: The client data, shared by every session without being
+        pickled; call .to_pandas() to get a DataFrame.
+    """
     url = "http://metabase.prod.tessan.cloud/public/question/6c3c45ab-7379-4815-8941-dcd6763c555c.csv"
-    clients = pd.read_csv(url)
-    return clients
+    response = get_http_session().get(url, timeout=30)
+    response.raise_for_status()
+    clients = pd.read_csv(
+        io.BytesIO(response.content),
+        usecols=['Name', 'Address', 'AdministrativeArea2', 'PostalCode', 'Locality'],
+        dtype={'AdministrativeArea2': 'category', 'PostalCode': 'string', 'Locality': 'category'},
+    )
+    return pa.Table.from_pandas(clients)
 
 @st.cache_data(show_spinner=False)
+def load_department_list():
+    """Sorted departments ("AdministrativeArea2") having at least one client address."""
+    clients = load_data().to_pandas().dropna(subset=['Address'])
+    return tuple(sorted(clients['AdministrativeArea2'].dropna().unique().tolist()))
+
+@st.cache_resource(ttl=86400, show_spinner=False)
+def load_departements():
+    """Load the French departments GeoJSON (shared across sessions, refreshed daily)."""
+    geojson_url = 'https://france-geojson.gregoiredavid.fr/repo/departements.geojson'
+    response = get_http_session().get(geojson_url, timeout=30)
+    response.raise_for_status()
+    return response.json()
+
+@st.cache_resource(show_spinner=False)
+def get_geocoder(api_key=OPEN_CAGE_API_KEY):
+    """Create a single OpenCage client using the shared HTTP session."""
+    geocoder = OpenCageGeocode(api_key)
+    geocoder.session = get_http_session()
+    return geocoder
+
+def normalize_address(query):
+    """Normalize an address into a cache key (lowercase, no accents, single spaces)."""
+    key = unicodedata.normalize("NFKD", str(query)).encode("ascii", "ignore").decode("ascii")
+    return re.sub(r"\s+", " ", key).lower().strip()
+
+def filter_departements(departements_geojson, department):
+    """
+    Keep only the GeoJSON feature of the given department.
+    
+    Parameters:
+        departements_geojson (dict): FeatureCollection of all French departments.
+        department (str): Department name, as found in "AdministrativeArea2".
+    
+    Returns:
+        dict: FeatureCollection with the matching feature, or every feature
+        if the department name is not found.
+    """
+    name = normalize_address(department)
+    features = [
+        feature for feature in departements_geojson['features']
+        if normalize_address(feature['properties']['nom']) == name
+    ]
+    if not features:
+        return departements_geojson
+    return {"type": "FeatureCollection", "features": features}
+
+@st.cache_resource(show_spinner=False)
+def get_geocode_cache():
+    """Open the persistent geocode cache, shared by every session."""
+    return diskcache.Cache(GEOCODE_CACHE_DIR)
+
+@st.cache_resource(show_spinner=False)
+def get_geocode_memory():
+    """
+    Load every entry of the persistent geocode cache into memory, once for
+    every session. Each value is kept with its expiry time, so entries stop
+    being served when they expire on disk.
+    """
+    geocode_cache = get_geocode_cache()
+    entries = {}
+    for key in geocode_cache:
+        value, expire_time = geocode_cache.get(key, expire_time=True)
+        if value is not None:
+            entries[key] = value, expire_time
+    return entries
+
+@st.cache_resource(max_entries=1, show_spinner=False)
+def load_offline_geocodes(mtime):
+    """
+    Load the addresses geocoded offline, keyed like the geocode cache. The
+    file modification time is part of the cache key so a new nightly file is
+    picked up.
+    """
+    # Rows without coordinates are skipped: those addresses go through online
+    # geocoding, whose "not found" results expire
+    geocoded = pd.read_parquet(GEOCODED_CLIENTS_PATH).dropna(subset=['lat', 'lng'])
+    return {
+        normalize_address(address): (lat, lng)
+        for address, lat, lng in zip(geocoded['Address'], geocoded['lat'], geocoded['lng'])
+    }
+
+def get_offline_geocodes():
+    """
+    Addresses geocoded offline: only addresses added since the last offline
+    refresh are sent to the geocoding APIs.
+    """
+    try:
+        mtime = os.path.getmtime(GEOCODED_CLIENTS_PATH)
+    except FileNotFoundError:
+        return {}
+    return load_offline_geocodes(mtime)
+
+@st.cache_resource(show_spinner=False)
+def get_opencage_request(api_key=OPEN_CAGE_API_KEY):
+    """
+    Create the rate-limited OpenCage call. It is cached so that every session
+    and worker thread shares a single limiter for the API key quota.
+    """
+    geocoder = get_geocoder(api_key)
+
+    @sleep_and_retry
+    @limits(calls=GEOCODE_RATE_CALLS, period=GEOCODE_RATE_PERIOD)
+    def opencage_request(query):
+        """Call OpenCage, waiting as long as needed to stay within the rate limit."""
+        return geocoder.geocode(query, **GEOCODE_PARAMS)
+
+    return opencage_request
+
+def lookup_geocode(key):
+    """Return the known (latitude, longitude) of a normalized address, or None."""
+    offline_geocodes = get_offline_geocodes()
+    if key in offline_geocodes:
+        return offline_geocodes[key]
+    entry = get_geocode_memory().get(key)
+    if entry is None:
+        return None
+    coords, expire_time = entry
+    if expire_time is not None and expire_time <= time.time():
+        return None
+    return coords
+
+def store_geocode(key, coords):
+    """Save the coordinates of a normalized address in the geocode cache."""
+    get_geocode_cache().set(key, coords, expire=GEOCODE_CACHE_EXPIRE)
+    get_geocode_memory()[key] = coords, time.time() + GEOCODE_CACHE_EXPIRE
+
 def get_geocode(query, api_key=OPEN_CAGE_API_KEY):
     """
     Get latitude and longitude for a given address using the OpenCage API.
+    Results are looked up in the offline geocodes and the persistent cache
+    (also filled by Mapbox batches) before calling the API.
     
     Parameters:
         query (str): The address to geocode.
@@ -33,17 +233,179 @@ def get_geocode(query, api_key=OPEN_CAGE_API_KEY):
     Returns:
         tuple: (latitude, longitude) or (None, None) if not found.
     """
-    geocoder = OpenCageGeocode(api_key)
+    key = normalize_address(query)
+    coords = lookup_geocode(key)
+    if coords is not None:
+        return coords
+
     try:
-        result = geocoder.geocode(query)
+        result = get_opencage_request(api_key)(query)
         if result and len(result) > 0:
-            return result[0]['geometry']['lat'], result[0]['geometry']['lng']
+            coords = result[0]['geometry']['lat'], result[0]['geometry']['lng']
         else:
-            return None, None
+            coords = None, None
     except Exception as e:
+        # Errors are not cached so that the address is retried on the next run
         st.error(f"Error geocoding {query}: {e}")
         return None, None
 
+    store_geocode(key, coords)
+    return coords
+
+def is_precise_mapbox_match(feature):
+    """Whether a Mapbox feature is an address or street matched with good confidence."""
+    properties = feature.get('properties') or {}
+    confidence = (properties.get('match_code') or {}).get('confidence')
+    return properties.get('feature_type') in MAPBOX_FEATURE_TYPES and confidence != 'low'
+
+def mapbox_batch_geocode(addresses):
+    """
+    Geocode addresses with the Mapbox batch API and store the precise matches
+    in the geocode cache. Unmatched or imprecise addresses are left to OpenCage.
+    
+    Parameters:
+        addresses (list): The addresses to geocode.
+    """
+    for start in range(0, len(addresses), MAPBOX_BATCH_SIZE):
+        chunk = addresses[start:start + MAPBOX_BATCH_SIZE]
+        try:
+            response = get_http_session().post(
+                MAPBOX_BATCH_URL,
+                params={"access_token": MAPBOX_ACCESS_TOKEN, "permanent": "true"},
+                json=[{"q": address, **MAPBOX_QUERY_OPTIONS} for address in chunk],
+                timeout=60,
+            )
+            response.raise_for_status()
+            batch = response.json()['batch']
+        except Exception as e:
+            st.warning(f"Mapbox batch geocoding failed, falling back to OpenCage: {e}")
+            return
+        for address, collection in zip(chunk, batch):
+            features = collection.get('features') or []
+            if features and is_precise_mapbox_match(features[0]):
+                lng, lat = features[0]['geometry']['coordinates'][:2]
+                store_geocode(normalize_address(address), (lat, lng))
+
+def geocode_addresses(addresses):
+    """
+    Geocode several addresses in parallel. Addresses only differing by
+    spacing, case or accents share the same cache key and are geocoded once.
+    
+    Parameters:
+        addresses (iterable): The addresses to geocode.
+    
+    Returns:
+        dict: address -> (latitude, longitude).
+    """
+    keys = {address: normalize_address(address) for address in addresses}
+    queries = {}
+    for address, key in keys.items():
+        queries.setdefault(key, address)
+
+    # Send every address not yet known to Mapbox in batches first
+    if MAPBOX_ACCESS_TOKEN:
+        missing = [address for key, address in queries.items() if lookup_geocode(key) is None]
+        if missing:
+            mapbox_batch_geocode(missing)
+
+    # Worker threads need the script context to report errors with st.error
+    ctx = get_script_run_ctx()
+    with ThreadPoolExecutor(
+        max_workers=GEOCODE_WORKERS,
+        initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx),
+    ) as executor:
+        results = dict(zip(queries, executor.map(get_geocode, queries.values())))
+    return {address: results[key] for address, key in keys.items()}
+
+def is_expired(path):
+    """Whether a geocoded data file is older than the geocode cache expiry."""
+    return time.time() - os.path.getmtime(path) > GEOCODE_CACHE_EXPIRE
+
+def prune_geocoded_data():
+    """Delete the expired geocoded data files."""
+    for name in os.listdir(GEOCODED_DATA_DIR):
+        path = os.path.join(GEOCODED_DATA_DIR, name)
+        try:
+            if is_expired(path):
+                os.remove(path)
+        except FileNotFoundError:
+            # Already removed by another session
+            pass
+
+def geocode_dataframe(data):
+    """
+    Add "lat" and "lng" columns to client data, reusing a previous result
+    stored on disk when the same rows were geocoded less than
+    GEOCODE_CACHE_EXPIRE ago.
+    
+    Parameters:
+        data (DataFrame): Client data with an "Address" column.
+    
+    Returns:
+        DataFrame: The data with float32 "lat"/"lng" columns (NaN if not found).
+    """
+    data_hash = hashlib.sha1(pd.util.hash_pandas_object(data, index=False).values).hexdigest()
+    geocoded_path = os.path.join(GEOCODED_DATA_DIR, f"{data_hash}.parquet")
+    if os.path.exists(geocoded_path) and not is_expired(geocoded_path):
+        return pd.read_parquet(geocoded_path)
+
+    # Geocode each distinct address once, then map the results back onto the rows
+    unique_addresses = data['Address'].unique()
+    coords = geocode_addresses(unique_addresses)
+    # Coordinates are stored as float32 (NaN where geocoding failed)
+    lat_lng = np.asarray(data['Address'].map(coords).tolist(), dtype=np.float32)
+    data = data.assign(lat=lat_lng[:, 0], lng=lat_lng[:, 1])
+
+    # Only persist complete results: addresses that failed with an error are
+    # missing from the geocode cache and must be retried on the next run
+    if all(lookup_geocode(normalize_address(address)) is not None for address in unique_addresses):
+        os.makedirs(GEOCODED_DATA_DIR, exist_ok=True)
+        tmp_path = f"{geocoded_path}.{threading.get_ident()}.tmp"
+        data.to_parquet(tmp_path)
+        os.replace(tmp_path, geocoded_path)
+        prune_geocoded_data()
+    return data
+
+@st.cache_data(show_spinner=False)
+def build_map_html(department, lats, lngs, popups):
+    """
+    Build the downloadable Folium map of the clients of a department.
+    
+    Parameters:
+        department (str): The selected department.
+        lats (tuple): Latitude of each client.
+        lngs (tuple): Longitude of each client.
+        popups (tuple): Popup HTML of each client.
+    
+    Returns:
+        str: The standalone HTML page of the map.
+    """
+    import folium
+    from folium.plugins import FastMarkerCluster
+
+    departements_geojson = filter_departements(load_departements(), department)
+    folium_map = folium.Map(location=[float(np.mean(lats)), float(np.mean(lngs))], zoom_start=6)
+
+    # Add GeoJSON overlay for the selected department
+    folium.GeoJson(
+        departements_geojson,
+        name="French Departments",
+        style_function=lambda x: {
+            "fillColor": "orange",
+            "color": "black",
+            "weight": 0.5,
+            "fillOpacity": 0.2,
+        },
+    ).add_to(folium_map)
+
+    # Add markers for each client, created client-side from a single
+    # [lat, lng, popup] array
+    marker_rows = list(zip(lats, lngs, popups))
+    FastMarkerCluster(marker_rows, callback=MARKER_CALLBACK).add_to(folium_map)
+
+    # Render the map to an HTML string in memory (no file shared between sessions)
+    return folium_map.get_root().render()
+
 # =============================================================================
 # Main App
 # =============================================================================
@@ -52,7 +414,7 @@ def main():
     st.title("Clients TESSAN")
 
     # Load data and drop rows missing an Address
-    data = load_data()
+    data = load_data().to_pandas()
     data = data.dropna(subset=['Address'])
     
     # -----------------------------------------------------------------------------
@@ -60,12 +422,11 @@ def main():
     # -----------------------------------------------------------------------------
     st.sidebar.header("Filtre")
     
-    # Get unique values for filtering from the CSV data
-    # For example, filter by department ("AdministrativeArea2")
-    departments = sorted(data['AdministrativeArea2'].dropna().unique().tolist())
+    # Filter by department ("AdministrativeArea2"), list computed once from the CSV data
+    departments = load_department_list()
     
     placeholder = "Veuillez choisir un département"
-    department_options = [placeholder] + departments
+    department_options = [placeholder, *departments]
     selected_department = st.sidebar.selectbox("Sélectionnez un département", department_options)
     
     # If the placeholder is still selected, show an info message and stop
@@ -73,6 +434,11 @@ def main():
         st.info("Veuillez choisir un département pour continuer.")
         st.stop()
 
+    # Map libraries are only needed once a department is selected: import them
+    # lazily to keep the first page render fast (Folium is imported in
+    # build_map_html)
+    import pydeck as pdk
+
     data = data[data['AdministrativeArea2'] == selected_department]
 
     # If no data remains after filtering, notify the user and exit
@@ -83,7 +449,7 @@ def main():
     # -----------------------------------------------------------------------------
     # Geocode Addresses (only for the filtered data)
     # -----------------------------------------------------------------------------
-    data[['lat', 'lng']] = data['Address'].apply(lambda x: pd.Series(get_geocode(x)))
+    data = geocode_dataframe(data)
     
     # Remove rows where geocoding failed
     data = data.dropna(subset=['lat', 'lng'])
@@ -93,50 +459,32 @@ def main():
         return
 
     # -----------------------------------------------------------------------------
-    # Build and Display the Map using Folium
+    # Build the Maps: pydeck (WebGL) for display, Folium for the HTML download
     # -----------------------------------------------------------------------------
     
-    # Load French departments GeoJSON
-    geojson_url = 'https://france-geojson.gregoiredavid.fr/repo/departements.geojson'
-    departements_geojson = requests.get(geojson_url).json()
+    # Load French departments GeoJSON, keeping only the selected department
+    departements_geojson = filter_departements(load_departements(), selected_department)
 
     # Center the map on the average location of the clients
-    average_lat = data['lat'].mean()
-    average_lon = data['lng'].mean()
-    folium_map = folium.Map(location=[average_lat, average_lon], zoom_start=6)
+    average_lat = float(np.mean(data['lat'].to_numpy()))
+    average_lon = float(np.mean(data['lng'].to_numpy()))
 
-    # Add GeoJSON overlay for French departments
-    folium.GeoJson(
-        departements_geojson,
-        name="French Departments",
-        style_function=lambda x: {
-            "fillColor": "orange",
-            "color": "black",
-            "weight": 0.5,
-            "fillOpacity": 0.2,
-        },
-    ).add_to(folium_map)
+    # Popup/tooltip HTML for each client, built column-wise
+    data = data.assign(popup=(
+        '<b>Name:</b> ' + data['Name'].astype(str)
+        + '<br><b>Address:</b> ' + data['Address'].astype(str)
+        + '<br><b>Department:</b> ' + data['AdministrativeArea2'].astype(str)
+        + '<br>'
+    ))
 
-    # Add markers for each client
-    for _, row in data.iterrows():
-        popup_content = f"""
-        <b>Name:</b> {row['Name']}<br>
-        <b>Address:</b> {row['Address']}<br>
-        <b>Department:</b> {row['AdministrativeArea2']}<br>
-        """
-        folium.Marker(
-            location=[row['lat'], row['lng']],
-            popup=popup_content,
-            icon=folium.Icon(color='darkgreen'),
-        ).add_to(folium_map)
-
-    # Save the map as an HTML file
+    # Render the Folium map to an HTML string (cached per department and clients)
     map_filename = 'client_map.html'
-    folium_map.save(map_filename)
-
-    # Read and display the saved HTML map in the Streamlit app
-    with open(map_filename, 'r', encoding='utf-8') as file:
-        html_data = file.read()
+    html_data = build_map_html(
+        selected_department,
+        tuple(data['lat'].tolist()),
+        tuple(data['lng'].tolist()),
+        tuple(data['popup'].tolist()),
+    )
 
     st.download_button(
         label="Download Map",
@@ -152,7 +500,32 @@ def main():
     if display_dataframe: 
         st.dataframe(data[columns_to_display])
 
-    st.components.v1.html(html_data, height=600, scrolling=True)
+    # Display the clients with pydeck: points are drawn on the GPU instead of
+    # one Leaflet marker per client
+    departement_layer = pdk.Layer(
+        "GeoJsonLayer",
+        data=departements_geojson,
+        get_fill_color=[255, 165, 0, 51],
+        get_line_color=[0, 0, 0],
+        line_width_min_pixels=1,
+    )
+    clients_layer = pdk.Layer(
+        "ScatterplotLayer",
+        data=data[['lat', 'lng', 'popup']],
+        get_position=["lng", "lat"],
+        get_radius=200,
+        radius_min_pixels=4,
+        get_fill_color=[34, 139, 34],
+        pickable=True,
+    )
+    st.pydeck_chart(
+        pdk.Deck(
+            layers=[departement_layer, clients_layer],
+            initial_view_state=pdk.ViewState(latitude=average_lat, longitude=average_lon, zoom=6),
+            tooltip={"html": "{popup}"},
+        ),
+        height=600,
+    )
 
 if __name__ == '__main__':
     main()
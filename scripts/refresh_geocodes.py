@@ -0,0 +1,159 @@
+"""
+Geocode every new client address offline.
+
+Reads the client CSV from Metabase, geocodes the addresses that are not yet in
+clients_geocoded.parquet and writes the ones found back, so the Streamlit app
+can show the map without calling the API. Addresses are sent in batches to
+Mapbox when MAPBOX_ACCESS_TOKEN is set, the ones it cannot match precisely
+(or all of them without a token) to OpenCage. Addresses not found are retried
+on the next run.
+
+Progress is saved regularly, and the script exits with status 1 if any address
+failed. It stops right away when the API key is refused or the quota is used up.
+
+Usage:
+    OPEN_CAGE_API_KEY=... [MAPBOX_ACCESS_TOKEN=...] python scripts/refresh_geocodes.py [output.parquet]
+"""
+
+import os
+import sys
+
+import pandas as pd
+import requests
+from opencage.geocoder import ForbiddenError, NotAuthorizedError, OpenCageGeocode, RateLimitExceededError
+from ratelimit import limits, sleep_and_retry
+
+CSV_URL = "http://metabase.prod.tessan.cloud/public/question/6c3c45ab-7379-4815-8941-dcd6763c555c.csv"
+DEFAULT_OUTPUT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "clients_geocoded.parquet")
+
+# Mapbox batch geocoding, used first when MAPBOX_ACCESS_TOKEN is set; only
+# precise matches in France are kept, anything else goes to OpenCage
+MAPBOX_BATCH_URL = "https://api.mapbox.com/search/geocode/v6/batch"
+MAPBOX_BATCH_SIZE = 1000
+MAPBOX_QUERY_OPTIONS = {"country": "fr", "autocomplete": False, "limit": 1}
+MAPBOX_FEATURE_TYPES = ("address", "street")
+
+# OpenCage free tier allows 1 request per second
+RATE_CALLS = 1
+RATE_PERIOD = 1.0
+
+# Errors affecting every request (bad key, quota used up): stop the run
+# instead of failing each remaining address
+FATAL_ERRORS = (NotAuthorizedError, ForbiddenError, RateLimitExceededError)
+
+# Number of newly geocoded addresses between two saves, so an interrupted run
+# keeps its progress
+SAVE_EVERY = 100
+
+def is_precise_mapbox_match(feature):
+    """Whether a Mapbox feature is an address or street matched with good confidence."""
+    properties = feature.get('properties') or {}
+    confidence = (properties.get('match_code') or {}).get('confidence')
+    return properties.get('feature_type') in MAPBOX_FEATURE_TYPES and confidence != 'low'
+
+def mapbox_batch_geocode(addresses, access_token):
+    """
+    Geocode addresses with the Mapbox batch API, MAPBOX_BATCH_SIZE per request.
+
+    Yields:
+        list: (address, latitude, longitude) of the precise matches of each batch.
+    """
+    with requests.Session() as session:
+        for start in range(0, len(addresses), MAPBOX_BATCH_SIZE):
+            chunk = addresses[start:start + MAPBOX_BATCH_SIZE]
+            response = session.post(
+                MAPBOX_BATCH_URL,
+                params={"access_token": access_token, "permanent": "true"},
+                json=[{"q": address, **MAPBOX_QUERY_OPTIONS} for address in chunk],
+                timeout=120,
+            )
+            response.raise_for_status()
+            matches = []
+            for address, collection in zip(chunk, response.json()['batch']):
+                features = collection.get('features') or []
+                if features and is_precise_mapbox_match(features[0]):
+                    lng, lat = features[0]['geometry']['coordinates'][:2]
+                    matches.append((address, lat, lng))
+            yield matches
+
+@sleep_and_retry
+@limits(calls=RATE_CALLS, period=RATE_PERIOD)
+def geocode(geocoder, address):
+    """Return (latitude, longitude) for an address, or (None, None) if not found."""
+    result = geocoder.geocode(address, limit=1, no_annotations=1)
+    if result and len(result) > 0:
+        return result[0]['geometry']['lat'], result[0]['geometry']['lng']
+    return None, None
+
+def save(geocoded, rows, output_path):
+    """Write the previously geocoded addresses and the new rows to Parquet."""
+    new_rows = pd.DataFrame(rows, columns=['Address', 'lat', 'lng']).astype({'lat': float, 'lng': float})
+    result = pd.concat([geocoded, new_rows], ignore_index=True)
+    tmp_path = f"{output_path}.tmp"
+    result.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, output_path)
+
+def main(output_path=DEFAULT_OUTPUT):
+    addresses = pd.read_csv(CSV_URL, usecols=['Address'])['Address'].dropna().unique()
+
+    if os.path.exists(output_path):
+        # Addresses without coordinates (not found, or written by older
+        # versions of this script) are dropped so they are retried
+        geocoded = pd.read_parquet(output_path).dropna(subset=['lat', 'lng'])
+    else:
+        geocoded = pd.DataFrame({'Address': pd.Series(dtype=str), 'lat': pd.Series(dtype=float), 'lng': pd.Series(dtype=float)})
+
+    known = set(geocoded['Address'])
+    new_addresses = [address for address in addresses if address not in known]
+    print(f"{len(new_addresses)} new addresses to geocode ({len(geocoded)} already geocoded)")
+    if not new_addresses:
+        return
+
+    rows = []
+    not_found = 0
+    failures = 0
+
+    mapbox_token = os.environ.get("MAPBOX_ACCESS_TOKEN")
+    if mapbox_token:
+        try:
+            for matches in mapbox_batch_geocode(new_addresses, mapbox_token):
+                rows.extend({'Address': address, 'lat': lat, 'lng': lng} for address, lat, lng in matches)
+                save(geocoded, rows, output_path)
+        except Exception as e:
+            print(f"Mapbox batch geocoding failed, falling back to OpenCage: {e}", file=sys.stderr)
+        print(f"{len(rows)} addresses geocoded by Mapbox")
+        matched = {row['Address'] for row in rows}
+        new_addresses = [address for address in new_addresses if address not in matched]
+
+    with OpenCageGeocode(os.environ["OPEN_CAGE_API_KEY"]) as geocoder:
+        for address in new_addresses:
+            try:
+                lat, lng = geocode(geocoder, address)
+            except FATAL_ERRORS as e:
+                print(f"Stopping, OpenCage refused the request: {e}", file=sys.stderr)
+                failures += 1
+                break
+            except Exception as e:
+                # Not written, so the address is retried on the next refresh
+                print(f"Error geocoding {address}: {e}", file=sys.stderr)
+                failures += 1
+                continue
+            if lat is None or lng is None:
+                # Not written either: the app falls back to online geocoding,
+                # whose cache entries expire
+                not_found += 1
+                continue
+            rows.append({'Address': address, 'lat': lat, 'lng': lng})
+            if len(rows) % SAVE_EVERY == 0:
+                save(geocoded, rows, output_path)
+
+    if rows:
+        save(geocoded, rows, output_path)
+    print(f"Geocoded {len(rows)} new addresses into {output_path} ({not_found} not found)")
+
+    if failures:
+        print(f"{failures} addresses could not be geocoded", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])